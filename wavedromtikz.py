@@ -2,10 +2,20 @@
 
 import yaml
 import argparse
+import io
+import re
 import sys
 import os.path
 from string import Template
 from collections import namedtuple
+from functools import lru_cache
+from itertools import accumulate, chain, repeat
+
+# Use the much faster LibYAML-based loader where PyYAML was built with it
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 STANDALONE_TEX_HEADER = r"""
 \documentclass[crop,tikz]{standalone}
@@ -25,18 +35,16 @@ STANDALONE_TEX_FOOTER = r"""
 \end{document}
 """
 
-# A TikZ (LaTeX) header to be included before a waveform diagram. Defines
-# various primitives for drawing parts of a waveform.
-TIKZ_HEADER = Template(r"""
+# TikZ (LaTeX) definitions of the various primitives for drawing parts of a
+# waveform. These do not vary between diagrams and so may be included just once
+# in a document's preamble (see TIKZ_DIAGRAM_HEADER).
+TIKZ_PREAMBLE = r"""
 % Seperation between lines
 \pgfmathsetlengthmacro{\wavesep}{2.0em}
 
 % Height of a waveform
 \pgfmathsetlengthmacro{\waveheight}{1.2em}
 
-% Width of a brick (half a cycle)
-\pgfmathsetlengthmacro{\wavewidth}{${size}em}
-
 % Width of the slant on slanted signal changes
 \pgfmathsetlengthmacro{\transitionwidth}{0.3em}
 
@@ -51,9 +59,6 @@ TIKZ_HEADER = Template(r"""
 \tikzset{wave busblue/.style={fill=blue!25!white}}
 \tikzset{wave pulled/.style={dotted}}
 
-% Initialise pointer
-\coordinate (last waveform);
-
 % Label for a signal. Arguments:
 %  #1: The human-readable label string
 \newcommand{\signallabel}[1]{
@@ -424,10 +429,28 @@ TIKZ_HEADER = Template(r"""
    \advancebrick{#1}
 }
 """
-)
+
+# The per-diagram part of the TikZ header which must be included at the start
+# of every waveform diagram.
+TIKZ_DIAGRAM_HEADER = Template(r"""
+% Width of a brick (half a cycle)
+\pgfmathsetlengthmacro{\wavewidth}{${size}em}
+
+% Initialise pointer
+\coordinate (last waveform);
+""")
+
+# A TikZ (LaTeX) header to be included before a waveform diagram. Defines
+# various primitives for drawing parts of a waveform.
+TIKZ_HEADER = Template(TIKZ_PREAMBLE + TIKZ_DIAGRAM_HEADER.template)
 
 BUSLABEL = r"\coordinate (bus %d) at ($(bus start)!0.5!(last brick)$);"
 
+# LaTeX special characters in signal names which have not already been
+# escaped by the user, i.e. which are not preceded by an odd number of
+# backslashes (an even number is a run of \\ line breaks)
+UNESCAPED_NAME_CHARS = re.compile(r"(?<!\\)((?:\\\\)*)([_%&#])")
+
 WaveSection = namedtuple("WaveSection",
                          ["wave_type",  # Either "bus", "bit"
                           "glitch",  # Glitch on continuations of same signal
@@ -513,6 +536,10 @@ for name, style, glitch in [("x",      "wave x",         False),
                                      )
 
 
+# Bricks are pure functions of a (hashable) WaveSection and a handful of
+# scalars and only a few distinct combinations appear in any given diagram so
+# the generated LaTeX is memoised rather than re-formatted for every brick.
+@lru_cache(maxsize=1024)
 def get_brick(wave, odd_brick, brick_width):
     """
     Return a LaTeX string which inserts a brick of the type indicated by wave.
@@ -540,6 +567,7 @@ def get_brick(wave, odd_brick, brick_width):
         )
 
 
+@lru_cache(maxsize=1024)
 def get_transition_brick(last_wave, wave, brick_width):
     """
     Return a LaTeX string which inserts a transition brick from last_wave to wave.
@@ -675,24 +703,43 @@ WAVEDROM_NAMES = {
 }
 
 
-def render_waveform(signal_params):
+def render_waveform_lines(signal_params):
     """
-    Produce TikZ for just the waveform of a given signal.
+    Produce a tuple of TikZ lines for just the waveform of a given signal.
     """
-    wave = signal_params.get("wave", "")
-    node = signal_params.get("node", "")
+    # The cache key must be hashable: non-string data and node lists (which
+    # may contain arbitrary YAML values) are reduced to tuples of the strings
+    # they are formatted as anyway.
     data = signal_params.get("data", [])
-    phase = signal_params.get("phase", 0.0)
-    period = signal_params.get("period", 1.0)
+    if not isinstance(data, str):
+        data = tuple(str(datum) for datum in data)
+    node = signal_params.get("node", "")
+    if not isinstance(node, str):
+        node = tuple(str(node_name) for node_name in node)
 
-    assert period >= 0.0, "Period must be positive or zero."
+    return _render_waveform_lines(signal_params.get("wave", ""),
+                                  node,
+                                  data,
+                                  float(signal_params.get("phase", 0.0)),
+                                  float(signal_params.get("period", 1.0)))
+
+
+# Diagrams frequently repeat identical rows (clocks in particular) so whole
+# waveforms are memoised on the (hashable) parameters they depend on.
+@lru_cache(maxsize=1024)
+def _render_waveform_lines(wave, node, data, phase, period):
+    """
+    Implementation of render_waveform_lines taking the signal parameters as
+    individual, hashable arguments.
+    """
+    # An explicit check (rather than an assert) so that invalid input is still
+    # rejected when running under python -O
+    if period < 0.0:
+        raise ValueError("Period must be positive or zero.")
 
     # No waveform for empty description
     if wave == "":
-        return ""
-
-    # Pad node list
-    node += "." * max(0, len(wave) - len(node))
+        return ()
 
     # Split up data in strings
     if isinstance(data, str):
@@ -701,24 +748,41 @@ def render_waveform(signal_params):
     # Set up the 'last brick' pointer at the start of the waveform.
     out = [r"\coordinate (last brick) at (last waveform);"]
 
-    # Start assuming the signal is x if not otherwise specified
-    last_signal = "x" if wave[0] in ".|" else wave[0]
-
-    # Draw the first part of the waveform to get the phase right
-    if phase < 0.0:
-        # -ve phase advances the waveform rightward
-        out.append(r"\advancebrick{%f}" % (-phase * 2.0))
-    if phase > 0.0:
-        # +ve phase advances the waveform leftward
-        out.append(r"\truncatewaveform{%f}{%f}{%d}" %
-                   (period, phase * 2.0, len(wave) * 2))
+    # Resolve every continuation ('.' or '|') to the WaveSection it continues
+    # in a single pass, starting assuming the signal is x if not otherwise
+    # specified. waves[time] is then the WaveSection before timeslot time and
+    # waves[time + 1] the one during it.
+    waves = [WAVEDROM_NAMES[signal] for signal in accumulate(
+        wave,
+        lambda last_signal, signal: last_signal if signal in ".|" else signal,
+        initial="x" if wave[0] in ".|" else wave[0])]
+
+    # Draw the first part of the waveform to get the phase right (the common
+    # zero-phase case needs nothing)
+    if phase:
+        # Phase in bricks (half cycles)
+        phase_bricks = phase * 2.0
+        if phase_bricks < 0.0:
+            # -ve phase advances the waveform rightward
+            out.append(r"\advancebrick{%f}" % (-phase_bricks))
+        else:
+            # +ve phase advances the waveform leftward
+            out.append(r"\truncatewaveform{%f}{%f}{%d}" %
+                       (period, phase_bricks, len(wave) * 2))
 
     # Has the start of a bus been observed?
     bus_started = False
     bus_number = 0
 
+    # The period is fixed for the whole waveform so the spacer overlay need
+    # only be formatted once
+    spacer = r"\brickspaceroverly{%f}" % (period)
+
     # Draw the waveform, one timeslot at a time
-    for time, (signal, node_name) in enumerate(zip(wave, node)):
+    for time, (signal, last_wave, continued_wave, node_name) in \
+            enumerate(zip(wave, waves, waves[1:],
+                          # Pad node list
+                          chain(node, repeat(".")))):
         # Add a coordinate (which may be overwritten by a transition brick) to
         # indicate the current transition point
         out.append(r"\coordinate (last transition) at (last brick);")
@@ -736,18 +800,14 @@ def render_waveform(signal_params):
             out.append(r"\coordinate (bus start) at (last brick);")
             bus_started = True
 
-        continued_signal = last_signal if signal in ".|" else signal
         # First half of the waveform/transition
         if time == 0 or signal in ".|":
-            out.append(get_brick(WAVEDROM_NAMES[continued_signal], 0, period))
+            out.append(get_brick(continued_wave, 0, period))
         else:
-            out.append(get_transition_brick(WAVEDROM_NAMES[last_signal],
-                                            WAVEDROM_NAMES[continued_signal],
-                                            period
-                                            ))
+            out.append(get_transition_brick(last_wave, continued_wave, period))
 
         # Second half of the waveform
-        out.append(get_brick(WAVEDROM_NAMES[continued_signal], 1, period))
+        out.append(get_brick(continued_wave, 1, period))
 
         # Record transition node positions
         if node_name != ".":
@@ -755,9 +815,7 @@ def render_waveform(signal_params):
 
         # Draw the spacer spacer
         if signal == "|":
-            out.append(r"\brickspaceroverly{%f}" % (period))
-
-        last_signal = continued_signal
+            out.append(spacer)
 
     # Add final bus label
     if bus_started:
@@ -769,7 +827,32 @@ def render_waveform(signal_params):
     for i, datum in zip(range(bus_number), data):
         out.append(r"\busdata{bus %d}{%s};" % (i, datum))
 
-    return "\n".join(out)
+    return tuple(out)
+
+
+def render_waveform(signal_params):
+    """
+    Produce TikZ for just the waveform of a given signal.
+    """
+    return "\n".join(render_waveform_lines(signal_params))
+
+
+def render_signal_lines(signal_params):
+    """
+    Produce a list of TikZ lines defining the given waveform line with
+    parameters as used by WaveDrom.
+    """
+    name = UNESCAPED_NAME_CHARS.sub(r"\1\\\2",
+                                    signal_params.get("name", ""))
+
+    out = [r"\signallabel{%s}" % (name),
+           r"% A scope to ensure correct styling and limit the effect of clipping",
+           r"\begin{scope}[line cap=rect, line join=round]"]
+    out.extend(render_waveform_lines(signal_params))
+    out.append(r"\end{scope}")
+    out.append(
+        r"\coordinate (last waveform) at ([yshift=-\wavesep]last waveform);")
+    return out
 
 
 def render_signal(signal_params):
@@ -777,17 +860,7 @@ def render_signal(signal_params):
     Produce a TikZ string defining the given waveform line with parameters as
     used by WaveDrom.
     """
-    return r"""
-       \signallabel{%s}
-       %% A scope to ensure correct styling and limit the effect of clipping
-       \begin{scope}[line cap=rect, line join=round]
-          %s
-       \end{scope}
-       \coordinate (last waveform) at ([yshift=-\wavesep]last waveform);
-    """ % (
-        signal_params.get("name", "").replace('_', '\_'),
-        render_waveform(signal_params)
-    )
+    return "\n".join(render_signal_lines(signal_params))
 
 
 def render_help_lines(wavedrom):
@@ -795,12 +868,19 @@ def render_help_lines(wavedrom):
     Produce TikZ for a set of helplines on clock edges large enough to fill the
     space taken by the given WaveDrom.
     """
-    width = max((int(len(signal.get("wave", "")) * signal.get("period", 1.0))
-                 - int(signal.get("phase", 0.0)))
-                for signal in wavedrom["signal"]
-                )
+    signals = wavedrom["signal"]
 
-    height = len(wavedrom["signal"])
+    width = None
+    for signal in signals:
+        signal_width = (int(len(signal.get("wave", "")) *
+                            signal.get("period", 1.0)) -
+                        int(signal.get("phase", 0.0)))
+        if width is None or signal_width > width:
+            width = signal_width
+    if width is None:
+        raise ValueError("WaveDrom must contain at least one signal.")
+
+    height = len(signals)
 
     return r"""
        \foreach \tick in {0,...,%d}{
@@ -813,40 +893,74 @@ def render_help_lines(wavedrom):
     )
 
 
-def render_wavedrom(wavedrom):
+def write_wavedrom(wavedrom, stream, include_header=True):
+    """
+    Write TikZ for a complete WaveDrom diagram to the file-like object stream.
+
+    The output is written one signal at a time so that the complete diagram
+    need never be held in memory at once.
+
+    If include_header is False, the definitions in TIKZ_PREAMBLE are omitted
+    and must instead be included once elsewhere in the document (e.g. in its
+    preamble).
+    """
     hscale = wavedrom.get("config", {}).get("hscale",1)
-    return r"%s%s%s" % (TIKZ_HEADER.safe_substitute(size=hscale),
-                        render_help_lines(wavedrom),
-                        "\n".join(render_signal(signal_params)
-                                  for signal_params in wavedrom["signal"])
-                        )
+
+    write = stream.write
+    # The (large) preamble is constant and so written out as-is; only the
+    # small per-diagram part of TIKZ_HEADER needs substituting.
+    if include_header:
+        write(TIKZ_PREAMBLE)
+    write(TIKZ_DIAGRAM_HEADER.safe_substitute(size=hscale))
+    write("\n")
+    write(render_help_lines(wavedrom))
+    for signal_params in wavedrom["signal"]:
+        write("\n")
+        write("\n".join(render_signal_lines(signal_params)))
+
+
+def render_wavedrom(wavedrom, include_header=True):
+    """
+    Produce TikZ for a complete WaveDrom diagram. See write_wavedrom.
+    """
+    out = io.StringIO()
+    write_wavedrom(wavedrom, out, include_header)
+    return out.getvalue()
 
 
 def print_header(args):
-    print(TIKZ_HEADER)
+    print(TIKZ_PREAMBLE)
 
 
 def print_render_signal(args):
-    print(render_signal(yaml.safe_load(" ".join(args.signal))))
+    print(render_signal(yaml.load(" ".join(args.signal), Loader=_YamlLoader)))
 
 
 def print_render_wavedrom(args):
 
-    with open(args.path, 'r') as input_file:
-        wavedrom = render_wavedrom(yaml.safe_load(input_file.read()))
-
-        if args.standalone:
-            wavedrom = "\n".join(
-                [STANDALONE_TEX_HEADER, wavedrom, STANDALONE_TEX_FOOTER])
-        if args.output == sys.stdout:
-            print(wavedrom)
-        else:
-            if os.path.isdir(args.output):
-                args.output = os.path.join(args.output, os.path.splitext(
-                    os.path.basename(args.path))[0] + ".tikz")
-                print(args.output)
-            with open(args.output, 'w') as output_file:
-                output_file.write(str(wavedrom))
+    with open(args.path, 'rb') as input_file:
+        wavedrom = yaml.load(input_file, Loader=_YamlLoader)
+
+    # Render the complete diagram before any output is opened (or truncated)
+    # so that a rendering error never leaves a partial diagram behind
+    out = io.StringIO()
+    if args.standalone:
+        out.write(STANDALONE_TEX_HEADER + "\n")
+    write_wavedrom(wavedrom, out,
+                   include_header=args.standalone or not args.no_header)
+    if args.standalone:
+        out.write("\n" + STANDALONE_TEX_FOOTER)
+    wavedrom = out.getvalue()
+
+    if args.output == sys.stdout:
+        print(wavedrom)
+    else:
+        if os.path.isdir(args.output):
+            args.output = os.path.join(args.output, os.path.splitext(
+                os.path.basename(args.path))[0] + ".tikz")
+            print(args.output)
+        with open(args.output, 'w') as output_file:
+            output_file.write(wavedrom)
 
 
 if __name__ == "__main__":
@@ -867,6 +981,11 @@ if __name__ == "__main__":
         '-o', '--output', default=sys.stdout, type=str, help='output TikZ file')
     wavedrom_parser.add_argument('-s', '--standalone', default=False,
                                  action='store_true', help='Create standalone tex file')
+    wavedrom_parser.add_argument('-n', '--no-header', default=False,
+                                 action='store_true',
+                                 help='Omit the definitions printed by the '
+                                      '"header" command (ignored with '
+                                      '--standalone)')
     wavedrom_parser.add_argument('path', type=str, help='input wavedrom file')
     wavedrom_parser.set_defaults(func=print_render_wavedrom)
 